@@ -3,8 +3,11 @@
 """ Unit testing module for what-if parser. """
 
 
-from what_if_parse import process_article
+from what_if_parse import process_article, get_page_url
+import os
+import tempfile
 import unittest
+import unittest.mock
 
 
 class ParserTests(unittest.TestCase):
@@ -30,7 +33,7 @@ class ParserTests(unittest.TestCase):
         </section></body></html>
     """
 
-    def do_check_equal(self, article_html, article_md):
+    def do_check_equal(self, article_html, article_md, no_link_title=False):
         """ Wrap HTML paragraps into the template, parse and equal check."""
         html = bytes(self.HTML_TMPL.format(
             prev_url=self.PREV_URL,
@@ -40,7 +43,8 @@ class ParserTests(unittest.TestCase):
         args = {
             'native_newline': False,
             'verbose': False,
-            'no_link_title': False,
+            'no_link_title': no_link_title,
+            'refresh_link_titles': False,
         }
         md = process_article(ParserTests.PAGE_URL, html, args)[1]
 
@@ -51,8 +55,14 @@ class ParserTests(unittest.TestCase):
         self.assertEqual(md, exp)
 
     def setUp(self):
-        """ Setting up, nothing to do. """
-        pass
+        """ Keep the titles cache out of the user's home directory. """
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = unittest.mock.patch(
+            'what_if_parse.TITLE_CACHE_FILE',
+            os.path.join(cache_dir.name, 'titles'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_italic_1(self):
         """ Test a italic text inside a italic text. """
@@ -66,6 +76,90 @@ class ParserTests(unittest.TestCase):
         article_md = '*abc**012**def*'
         self.do_check_equal(article_html, article_md)
 
+    def test_links_1(self):
+        """ Test references order and a repeated link. """
+        article_html = '<p><a href="/1/">one</a>, ' \
+            '<a href="https://xkcd.com/">two</a> and ' \
+            '<a href="/1/">one again</a></p>'
+        article_md = '[one][1], [two][2] and [one again][1]\n\n' \
+            '[1]: https://what-if.xkcd.com/1/ "TODO"\n\n' \
+            '[2]: https://xkcd.com/ "TODO"'
+        self.do_check_equal(article_html, article_md, no_link_title=True)
+
+    def test_links_2(self):
+        """ Test relative links. """
+        article_html = '<p><a href="smth.html">one</a> and ' \
+            '<a href="../2/">two</a></p>'
+        article_md = '[one][1] and [two][2]\n\n' \
+            '[1]: https://what-if.xkcd.com/10000/smth.html "TODO"\n\n' \
+            '[2]: https://what-if.xkcd.com/2/ "TODO"'
+        self.do_check_equal(article_html, article_md, no_link_title=True)
+
+    def test_links_3(self):
+        """ Test links with escaped characters in the text and attributes. """
+        article_html = '<p><a href="https://example.com/">Q &amp; A</a> ' \
+            '<a href="https://example.org/" title="a > b">one ' \
+            '<u title="x>y">two</u> &amp; &lt;3</a></p>'
+        article_md = '[Q & A][1] [one <u title="x&gt;y">two</u> ' \
+            '&amp; &lt;3][2]\n\n' \
+            '[1]: https://example.com/ "TODO"\n\n' \
+            '[2]: https://example.org/ "TODO"'
+        self.do_check_equal(article_html, article_md, no_link_title=True)
+
+    def test_formula_1(self):
+        """ Test a non-inline formula and a paragraph that isn't one. """
+        article_html = '<p>  \\[ E = mc^2 \\]\n</p><p>\\[ a \\] b</p>'
+        article_md = '$$ E = mc^2 $$\n\n\\[ a \\] b'
+        self.do_check_equal(article_html, article_md)
+
+    def test_unknown_tag_1(self):
+        """ Test elements without a handler followed by escaped text. """
+        article_html = '<p>a<u> </u>b &amp; c &lt;d&gt; <u>\n</u>e<u></u>' \
+            '<u>f</u>&amp;</p>'
+        article_md = 'a<u> </u>b &amp; c &lt;d&gt; <u>\n</u>e<u></u>' \
+            '<u>f</u>&amp;'
+        self.do_check_equal(article_html, article_md)
+
+    def test_unknown_tag_2(self):
+        """ Test a carriage return after an element without a handler. """
+        article_html = '<p>a<u></u>b&#13;c &amp;<u> </u>&#13;d</p>'
+        article_md = 'a<u></u>b\rc &amp;<u> </u>\rd'
+        self.do_check_equal(article_html, article_md)
+
+    def test_img_1(self):
+        """ Test images without a title and with an empty title. """
+        article_html = '<img src="/imgs/a/1/one.png">' \
+            '<img src="/imgs/a/1/two.png" title="">'
+        article_md = '![](/uploads/10000-a-testing-title/one_ru.png)\n' \
+            '[labels]\nTODO\n[/labels]\n' \
+            'render: ![](https://what-if.xkcd.com/imgs/a/1/one.png)\n\n' \
+            '![](/uploads/10000-a-testing-title/two_ru.png)\n' \
+            '[labels]\nTODO\n[/labels]\n' \
+            'render: ![](https://what-if.xkcd.com/imgs/a/1/two.png)'
+        self.do_check_equal(article_html, article_md)
+
+    def test_img_2(self):
+        """ Test an image title with quotes. """
+        article_html = '<img src="/imgs/a/1/pic.png" ' \
+            'title="Say &quot;hi&quot;">'
+        article_md = '![](/uploads/10000-a-testing-title/pic_ru.png ' \
+            '"Say \\"hi\\"")\n[labels]\nTODO\n[/labels]\n' \
+            'render: ![](https://what-if.xkcd.com/imgs/a/1/pic.png)'
+        self.do_check_equal(article_html, article_md)
+
+
+class UrlTests(unittest.TestCase):
+    """ Set of tests for URL handling. """
+
+    def test_page_url_1(self):
+        """ Test a fragment drop and a host lowercasing. """
+        self.assertEqual(get_page_url('HTTPS://User@Example.COM/A?b#c'),
+                         'https://User@example.com/A?b')
+
+    def test_page_url_2(self):
+        """ Test a malformed URL. """
+        self.assertEqual(get_page_url('http://[foo/x#y'), 'http://[foo/x')
+
 
 if __name__ == '__main__':
     unittest.main()
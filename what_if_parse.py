@@ -9,12 +9,23 @@ The module defines set of functions for downloading and parsing articles from
 
 import os
 import re
+import atexit
+import dbm
+import shelve
+import contextlib
 import sys
 import io
 import logging
-from datetime import tzinfo, timedelta, datetime
+import functools
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone, timedelta, datetime
+from urllib.parse import urlsplit, urlunsplit, urljoin
+import lxml.etree
 import lxml.html
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from requests.exceptions import RequestException, BaseHTTPError
 
 
@@ -29,18 +40,122 @@ NOTABENOID_SPACES_WORKAROUND = True
 TIMEZONE_OFFSET_HOURS = 3
 # Avoid infinite freeze.
 HTTP_TIMEOUT = 10
-
-
-class TZ(tzinfo):
-    """ Hardcoded Moscow timezone """
-    def utcoffset(self, dt):
-        return timedelta(hours=TIMEZONE_OFFSET_HOURS)
-
-    def dst(self, dt):
-        return timedelta(hours=TIMEZONE_OFFSET_HOURS)
-
-    def tzname(self, dt):
-        return "MSK"
+# Reference titles downloaded simultaneously.
+TITLE_WORKERS = 16
+# Repeat failed requests and requests answered with server errors. The first
+# retry is sent at once, next ones after HTTP_RETRY_BACKOFF * 2 ** (retry - 1)
+# seconds, i.e. 0.4 and 0.8 seconds.
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.2
+# Titles of different pages remembered during a run.
+TITLE_CACHE_SIZE = 1024
+# Titles remembered between runs. Failures aren't stored to retry them next
+# time.
+TITLE_CACHE_FILE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'what_if_parse', 'titles')
+# Titles older than that (in seconds) are downloaded again.
+TITLE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# Articles downloaded ahead in the 'all' mode.
+ARTICLE_PREFETCH = 4
+# Keep-alive connections kept open per host, should not be less than
+# TITLE_WORKERS to avoid discarding connections.
+HTTP_POOL_SIZE = 32
+# Pages larger than that aren't downloaded, a body is read by chunks.
+HTTP_MAX_PAGE_SIZE = 16 * 1024 * 1024
+HTTP_CHUNK_SIZE = 64 * 1024
+# Identify the script to sites it downloads pages from.
+USER_AGENT = 'what_if_parse'
+
+
+# Shared by all requests to reuse TCP and TLS connections: references often
+# point to the same hosts.
+SESSION = requests.Session()
+# When retries are exhausted the last response is returned to report its
+# status code. Retry-After is ignored: a server could otherwise make a
+# request wait for any time it wants.
+HTTP_ADAPTER = HTTPAdapter(
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,
+        raise_on_status=False))
+SESSION.mount('http://', HTTP_ADAPTER)
+SESSION.mount('https://', HTTP_ADAPTER)
+SESSION.headers['User-Agent'] = USER_AGENT
+atexit.register(SESSION.close)
+
+
+# XPath expressions are compiled once instead of on each call.
+XPATH_PREV_BUTTON = lxml.etree.XPath('//body//nav/a/button[@class="prev"]')
+XPATH_ARTICLE_TITLE = lxml.etree.XPath('//body//h2[@id="title"]/a')
+XPATH_REFBODY = lxml.etree.XPath('./span[@class="refbody"]')
+
+
+# Hardcoded Moscow timezone.
+TZ = timezone(timedelta(hours=TIMEZONE_OFFSET_HOURS), 'MSK')
+
+
+# Replacements of title characters for slugify().
+SLUG_TABLE = str.maketrans({
+    ' ': '-',
+    '.': None,
+    ',': None,
+    "'": None,
+    '!': None,
+    '$': None,
+    ':': None,
+})
+
+
+# Regular expressions are compiled once instead of looking them up in the re
+# module cache on each call.
+SPACES_RE = re.compile(r'[\f\n\r\t\v ]+')
+PREV_URL_RE = re.compile(r'^https://[^/]+/(?P<num>\d+)/?(?:#.*)?$')
+FORMULA_RE = re.compile(r'\A\s*\\\[(?P<formula>.*)\\\]\s*\Z', re.DOTALL)
+
+
+# Reference pages with these extensions have no title.
+NON_HTML_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.svg',
+                       '.zip', '.gz', '.tar', '.mp3', '.mp4', '.mov')
+
+
+# URLs that full_url() returns as is.
+ABSOLUTE_URL_PREFIXES = ('http://', 'https://', 'ftp://', 'doi:')
+
+
+# Markdown marks for <em/> and <strong/> and alternate ones used for nested
+# elements of the same kind.
+EM = 0
+STRONG = 1
+DEFAULT_MARKS = ('*', '**')
+ALTERNATE_MARKS = ('_', '__')
+
+
+class ParserState:
+    """ State of an article parsing shared by 'process_*' functions. """
+    # Attributes are read on each processed element, slots make it faster
+    # than dict lookups.
+    __slots__ = ('num', 'slug', 'base_url', 'fn_counter', 'par_sep',
+                 'line_break', 'indent', 'footnotes', 'references', 'args')
+
+    def __init__(self, url, args):
+        self.num = None
+        self.slug = None
+        self.base_url = url
+        self.fn_counter = 1
+        self.par_sep = '\n\n'
+        self.line_break = '\n'
+        if NOTABENOID_SPACES_WORKAROUND:
+            self.indent = '<-->'
+        else:
+            self.indent = ' ' * 4
+        # Markdown of footnotes of the current paragraph.
+        self.footnotes = []
+        # Numbers of references by their URLs, in the order of numbers.
+        self.references = {}
+        self.args = args
 
 
 class GetPageError(Exception):
@@ -61,7 +176,7 @@ class GetPageError(Exception):
 
 
 def timestamp():
-    return datetime.now(TZ()).strftime('%Y%m%d-%H%M%S%z')
+    return datetime.now(TZ).strftime('%Y%m%d-%H%M%S%z')
 
 
 def safe_makedirs(directory):
@@ -70,19 +185,6 @@ def safe_makedirs(directory):
     os.makedirs(directory)
 
 
-def is_text_html(url):
-    try:
-        res = requests.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
-    except (RequestException, BaseHTTPError):
-        err = 'HTTP HEAD request failed before status code become available'
-        raise GetPageError(err, url)
-    if res.status_code != requests.codes['ok']:
-        err = 'HTTP HEAD request failed'
-        more = {'status_code': res.status_code}
-        raise GetPageError(err, url, more)
-    return res.headers['Content-Type'].startswith('text/html')
-
-
 # It always returns HTML content in it's original encoding, so you should
 # decode resulting string manually (e.g. using 'codecs' module) when you
 # intent to process HTML manually. When lxml used to parse HTML, it decodes
@@ -95,61 +197,153 @@ def get_page(url, raise_non_text_html=False):
     when download error occured.
 
     """
-    if not is_text_html(url):
-        if raise_non_text_html:
-            err = 'Content-Type is differs from text/html'
-            raise GetPageError(err, url)
-        else:
-            return None
+    # Only headers are received until the body is requested, so the
+    # content type is checked without a separate HEAD request.
     try:
-        res = requests.get(url, timeout=HTTP_TIMEOUT)
+        res = SESSION.get(url, stream=True, timeout=HTTP_TIMEOUT)
     except (RequestException, BaseHTTPError):
         err = 'HTTP GET request failed before status code become available'
         raise GetPageError(err, url)
-    if res.status_code != requests.codes['ok']:
-        err = 'HTTP GET request failed'
-        more = {'status_code': res.status_code}
-        raise GetPageError(err, url, more)
-    return res.content
+    with res:
+        if res.status_code != requests.codes['ok']:
+            err = 'HTTP GET request failed'
+            more = {'status_code': res.status_code}
+            raise GetPageError(err, url, more)
+        if not res.headers.get('Content-Type', '').startswith('text/html'):
+            if raise_non_text_html:
+                err = 'Content-Type is differs from text/html'
+                raise GetPageError(err, url)
+            else:
+                return None
+        err = 'Page is larger than %d bytes' % HTTP_MAX_PAGE_SIZE
+        content_length = res.headers.get('Content-Length', '')
+        if content_length.isdigit() and \
+                int(content_length) > HTTP_MAX_PAGE_SIZE:
+            raise GetPageError(err, url)
+        chunks = []
+        size = 0
+        try:
+            for chunk in res.iter_content(HTTP_CHUNK_SIZE):
+                size += len(chunk)
+                if size > HTTP_MAX_PAGE_SIZE:
+                    raise GetPageError(err, url)
+                chunks.append(chunk)
+        except (RequestException, BaseHTTPError):
+            err = 'HTTP GET request failed while reading the body'
+            raise GetPageError(err, url)
+        return b''.join(chunks)
 
 
-def get_title(reference, refs_cnt, default_res='TODO'):
-    """ Get a title of a page by its url.
+def find_first(html, tag, **options):
+    """ Parse HTML until the end of the first 'tag' element and return it.
+
+    The rest of the document is not parsed. Returns None if there is no such
+    element. Additional parser 'options' are passed to iterparse.
+
+    """
+    # Elements are never looked up by id, so don't index them.
+    events = lxml.etree.iterparse(io.BytesIO(html), html=True, tag=tag,
+                                  collect_ids=False, **options)
+    for _, elem in events:
+        return elem
+    return None
+
+
+def get_page_url(url):
+    """ Get URL of a page a link points to.
+
+    The fragment is dropped, the scheme and the host are lowercased. Only
+    the fragment is dropped from a malformed URL.
 
-    Download page from reference['url'] and extract title. If an error
-    occured during page download or title cannot be extracted, returns
-    a value of 'default_res' argument.
+    """
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url.split('#', 1)[0]
+    userinfo, at, host = parts.netloc.rpartition('@')
+    netloc = userinfo + at + host.lower()
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, ''))
+
+
+# Cache by the page URL: links to different parts of the same page share
+# the title.
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE)
+def fetch_title(page_url):
+    """ Download a page and extract its title.
+
+    Returns None if an error occured during page download or title cannot
+    be extracted.
 
     """
-    def cannot_get_warning(reference, exc):
-        logging.warning('Cannot get a title for "%s": %s',
-                        reference['url'], str(exc))
+    def cannot_get_warning(exc):
+        logging.warning('Cannot get a title for "%s": %s', page_url, str(exc))
 
-    log_header = '[get_title %d/%d] ' % (reference['num'], refs_cnt)
-    logging.info(log_header + 'Download page from %s', reference['url'])
     try:
-        html = get_page(reference['url'])
+        path = urlsplit(page_url).path
+    except ValueError as exc:
+        cannot_get_warning(exc)
+        return None
+    # Don't send requests that cannot give a title.
+    if not page_url.startswith(('http://', 'https://')) or \
+            path.lower().endswith(NON_HTML_EXTENSIONS):
+        logging.info('Skip non-HTML page %s', page_url)
+        return None
+
+    logging.info('Download page from %s', page_url)
+    try:
+        html = get_page(page_url)
     except GetPageError as exc:
-        cannot_get_warning(reference, exc)
-        return default_res
+        cannot_get_warning(exc)
+        return None
     if html is None:
-        return default_res
-    logging.info(log_header + 'Extract title from the page')
-    doc = lxml.html.document_fromstring(html)
-    titles = doc.xpath('//title')
-    if len(titles) == 0:
-        return default_res
-    res = ''
+        return None
     try:
-        title = titles[0].text
+        title_elem = find_first(html, 'title', remove_comments=True,
+                                remove_pis=True)
+    except lxml.etree.XMLSyntaxError as exc:
+        cannot_get_warning(exc)
+        return None
+    if title_elem is None:
+        return None
+    try:
+        title = title_elem.text
     except UnicodeDecodeError as exc:
-        cannot_get_warning(reference, exc)
+        cannot_get_warning(exc)
+        return None
+    if title is None:
+        return None
+    # Collapse a multiline title into one line.
+    return ' '.join(title.split())
+
+
+def get_title(num, url, refs_cnt, default_res='TODO'):
+    """ Get a title of a page by its url.
+
+    Download page from 'url' of reference number 'num' and extract title. If
+    an error occured during page download or title cannot be extracted,
+    returns a value of 'default_res' argument.
+
+    """
+    log_header = '[get_title %d/%d] ' % (num, refs_cnt)
+    logging.info(log_header + 'Get title of %s', url)
+    page_url = get_page_url(url)
+    title = fetch_title(page_url)
+    if title is None:
         return default_res
-    for line in title.split('\n'):
-        line = line.strip()
-        if len(line) > 0:
-            res += line + ' '
-    return res.rstrip()
+    return title
+
+
+# All URLs of an article are resolved against the same page URL.
+@functools.lru_cache()
+def split_context_url(context_url):
+    """ Split full URL into a scheme, a base (scheme and host) and a page URL
+    (without a fragment).
+
+    """
+    parts = urlsplit(context_url)
+    context_base = parts.scheme + '://' + parts.netloc
+    context_page = context_url.split('#', 1)[0]
+    return parts.scheme, context_base, context_page
 
 
 def full_url(url, context_url):
@@ -158,26 +352,23 @@ def full_url(url, context_url):
     Assume 'context_url' are full url.
 
     """
-    proto, tail = context_url.split(':', 1)
-    context_base = proto + '://' + tail.lstrip('/').split('/', 1)[0]
-    context_page = context_url.split('#', 1)[0]
+    # Most of links are absolute ones to other sites, check them first.
+    if url.startswith(ABSOLUTE_URL_PREFIXES):
+        return url
 
+    proto, context_base, context_page = split_context_url(context_url)
     if url == '':
         return context_page
-    elif url.startswith('#'):
+    elif url[0] == '#':
         return context_page + url
     elif url.startswith('//'):
         return proto + ':' + url
-    elif url.startswith('/'):
+    elif url[0] == '/':
         return context_base.rstrip('/') + '/' + url.lstrip('/')
-    elif url.startswith(('http://', 'https://', 'ftp://')):
-        return url
-    elif url.startswith('doi:'):
-        return url
     else:
-        # Need we support relational link like
-        # 'smth.html', './smth.html', or '../smth.html'?
-        raise NameError('bad url in \'full_url\':\nurl: ' + url + '\n')
+        # Relative links like 'smth.html', './smth.html' or '../smth.html'
+        # are rare enough to leave them to the generic (and slower) way.
+        return urljoin(context_page, url)
 
 
 def inner_html(node, strip=True):
@@ -186,9 +377,20 @@ def inner_html(node, strip=True):
     https://stackoverflow.com/a/24151860/1598057
 
     """
-    res = node.text or ''
-    for child in node:
-        res += lxml.html.tostring(child, encoding='unicode')
+    text = node.text or ''
+    if len(node) == 0:
+        res = text
+    elif '&' in text or '<' in text or '>' in text:
+        # The text is escaped in a serialized node, so serialize childs one
+        # by one.
+        parts = [text]
+        for child in node:
+            parts.append(lxml.html.tostring(child, encoding='unicode'))
+        res = ''.join(parts)
+    else:
+        # Serialize the node at once and cut its own tags off.
+        res = lxml.html.tostring(node, encoding='unicode', with_tail=False)
+        res = res[res.index('>') + 1:res.rindex('<')]
     if strip:
         res = res.strip()
     return res
@@ -204,41 +406,27 @@ def normalize_space(txt):
     """
     if not txt:
         return ''
-    return re.sub(r'[\f\n\r\t\v ]+', ' ', txt)
+    return SPACES_RE.sub(' ', txt)
 
 
 def pop_footnotes(state):
     """ Get preparsed footnotes text and flush it. """
-    res = ''
-    for footnote in state['footnotes']:
-        if footnote['is_multipar']:
-            template = '[^%s]:\n%s'
-            if NOTABENOID_SPACES_WORKAROUND:
-                template = 'TODO: replace \'<-->\' with \'    \'\n' + template
-        else:
-            template = '[^%s]: %s'
-        res += template % (footnote['num'], footnote['body'])
-        res += state['par_sep']
-    state['footnotes'] = []
-    return res
+    parts = []
+    for footnote in state.footnotes:
+        parts.append(footnote)
+        parts.append(state.par_sep)
+    state.footnotes = []
+    return ''.join(parts)
 
 
 def slugify(num, title):
-    num_zero_filled = str(num).rjust(3, '0')
-    title_slugified = title.lower() \
-        .replace(' ', '-') \
-        .replace('.', '') \
-        .replace(',', '') \
-        .replace("'", '') \
-        .replace('!', '') \
-        .replace('$', '') \
-        .replace(':', '')
+    num_zero_filled = str(num).zfill(3)
+    title_slugified = title.lower().translate(SLUG_TABLE)
     return '{}-{}'.format(num_zero_filled, title_slugified)
 
 
 def prefix_each_line(prefix, data):
-    lines = [(line + '\n') for line in data.split('\n')]
-    return prefix + prefix.join(lines).rstrip('\n')
+    return prefix + data.replace('\n', '\n' + prefix)
 
 
 def process_article_title(doc, state):
@@ -250,138 +438,158 @@ def process_article_title(doc, state):
     # Previous article number + 1. If the URL is just '#', it is the first
     # article.
     num = 1
-    prev_button = doc.xpath('//body//nav/a/button[@class="prev"]')[0]
+    prev_button = XPATH_PREV_BUTTON(doc)[0]
     href = prev_button.getparent().get('href')
     if href != '#':
-        prev_url = full_url(href, context_url=state['base_url'])
-        m = re.match(r'^https://[^/]+/(?P<num>\d+)/?(?:#.*)?$', prev_url)
+        prev_url = full_url(href, context_url=state.base_url)
+        m = PREV_URL_RE.match(prev_url)
         if not m:
             raise RuntimeError('Unexpected previous article URL: {}'.format(
                 prev_url))
         num = int(m.group('num')) + 1
 
-    title = doc.xpath('//body//h2[@id="title"]/a')[0].text.strip()
+    title = XPATH_ARTICLE_TITLE(doc)[0].text.strip()
     url = 'https://what-if.xkcd.com/{}'.format(num)
 
-    state['num'] = num
-    state['slug'] = slugify(num, title)
+    state.num = num
+    state.slug = slugify(num, title)
 
-    res = title + state['line_break']
-    res += url + state['par_sep']
-    return res
+    return title + state.line_break + url + state.par_sep
 
 
-def process_a(a_elem, state):
+def process_a(a_elem, state, marks=DEFAULT_MARKS):
     """ Process inline <a/> element (somewhere under <article/>). """
     txt = normalize_space(inner_html(a_elem))
-    url = full_url(a_elem.get('href'), context_url=state['base_url'])
+    url = full_url(a_elem.get('href'), context_url=state.base_url)
 
     # check if we already have that URL (in case of two or more links to the
     # same page)
-    for ref in state['references']:
-        if ref['url'] == url:
-            return '[{}][{}]'.format(txt, ref['num'])
-
-    res = '[{}][{}]'.format(txt, state['ref_counter'])
-    ref = {
-        'num': state['ref_counter'],
-        'url': url,
-    }
-    state['references'].append(ref)
-    state['ref_counter'] += 1
-    return res
+    num = state.references.get(url)
+    if num is None:
+        num = len(state.references) + 1
+        state.references[url] = num
+    return '[{}][{}]'.format(txt, num)
+
+
+def ends_with_newline(parts):
+    """ Check whether concatenated 'parts' ends with a newline. """
+    for part in reversed(parts):
+        if part:
+            return part.endswith('\n')
+    return False
+
+
+def process_childs(elem, state, marks=DEFAULT_MARKS):
+    """ Process some inline HTML element (somewhere under <article/>).
 
+    Each child is processed by a handler from INLINE_HANDLERS or serialized
+    as is when there is no handler for its tag.
 
-def process_childs(elem, state, em_mark='*', strong_mark='**'):
-    """ Process some inline HTML element (somewhere under <article/>). """
-    res = normalize_space(elem.text)
+    """
+    parts = [normalize_space(elem.text)]
+    # Local names are faster to look up in the loop.
+    append = parts.append
+    get_handler = INLINE_HANDLERS.get
     for child in elem:
-        tail_added = False
-        # We can meet <p/> inside <blockquote/> as in
-        # https://what-if.xkcd.com/160.
-        if child.tag == 'p':
-            # TODO: A formula inside <p/>, which is inside
-            # <blockquote/>?
-            res += process_childs(child, state)
-            res += state['par_sep']
-        elif child.tag == 'em':
-            child_mark = '_' if em_mark == '*' else '*'
-            res += em_mark
-            res += process_childs(child, state, em_mark=child_mark)
-            res += em_mark
-        elif child.tag == 'strong' or child.tag == 'b':
-            child_mark = '__' if strong_mark == '**' else '**'
-            res += strong_mark
-            res += process_childs(child, state, strong_mark=child_mark)
-            res += strong_mark
-        elif child.tag == 'a':
-            res += process_a(child, state)
-        elif child.tag == 'span':
-            res += process_span(child, state)
-        elif child.tag == 'sup':
-            res += '^{'
-            res += process_childs(child, state)
-            res += '}'
-        elif child.tag == 'sub':
-            res += '_{'
-            res += process_childs(child, state)
-            res += '}'
-        elif child.tag == 'br':
-            res += state['par_sep']
-        elif child.tag == 'img':
-            res += process_img(child, state)
-        else:
+        handler = get_handler(child.tag)
+        if handler is None:
+            # Serialized together with the tail.
             tail = lxml.html.tostring(child, encoding='unicode')
-            if res.endswith('\n'):
-                tail = tail.lstrip()
-            res += tail
-            tail_added = True
-        if not tail_added:
+        else:
+            append(handler(child, state, marks))
             tail = normalize_space(child.tail)
-            if res.endswith('\n'):
-                tail = tail.lstrip()
-            res += tail
-    return res
+        if ends_with_newline(parts):
+            tail = tail.lstrip()
+        append(tail)
+    return ''.join(parts)
+
+
+def process_inline_p(p_elem, state, marks):
+    """ Process <p/> element inside <blockquote/> as in
+    https://what-if.xkcd.com/160.
+
+    """
+    # TODO: A formula inside <p/>, which is inside <blockquote/>?
+    return process_childs(p_elem, state) + state.par_sep
+
+
+def process_emphasis(elem, state, marks, kind):
+    """ Process inline <em/>, <strong/> or <b/> element.
+
+    'kind' is EM or STRONG, an index into 'marks'. A nested element of the
+    same kind gets the alternate mark ('_' or '__') and vice versa.
+
+    """
+    mark = marks[kind]
+    child_marks = list(DEFAULT_MARKS)
+    if mark == DEFAULT_MARKS[kind]:
+        child_marks[kind] = ALTERNATE_MARKS[kind]
+    return mark + process_childs(elem, state, tuple(child_marks)) + mark
+
+
+# Handlers for <em/> and <strong/> (or <b/>) with the kind baked in.
+process_em = functools.partial(process_emphasis, kind=EM)
+process_strong = functools.partial(process_emphasis, kind=STRONG)
 
 
-def process_span(span, state):
+def process_sup(sup, state, marks):
+    """ Process inline <sup/> element. """
+    return '^{' + process_childs(sup, state) + '}'
+
+
+def process_sub(sub, state, marks):
+    """ Process inline <sub/> element. """
+    return '_{' + process_childs(sub, state) + '}'
+
+
+def process_br(br, state, marks):
+    """ Process <br/> element. """
+    return state.par_sep
+
+
+def process_span(span, state, marks=DEFAULT_MARKS):
     """ Process inline <span/> element (somewhere under <article/>).
 
-    Detect footnotes (its formatted as <span/>) and save its into 'state',
-    later it will extracted in 'pop_footnotes' function. If span element isn't
-    footnote, then return raw its content.
+    Detect footnotes (its formatted as <span/>) and save its markdown into
+    'state', later it will extracted in 'pop_footnotes' function. If span
+    element isn't footnote, then return raw its content.
 
     """
     if span.get('class') != 'ref':
         return lxml.html.tostring(span, encoding='unicode')
 
-    res = '[^%s]' % state['fn_counter']
-    refbody = span.xpath('./span[@class="refbody"]')[0]
+    num = state.fn_counter
+    res = '[^%s]' % num
+    refbody = XPATH_REFBODY(span)[0]
     # TODO: formulas in footnotes?
     refbody_parsed = process_childs(refbody, state).strip()
-    is_multipar = state['par_sep'] in refbody_parsed
+    par_sep = state.par_sep
+    is_multipar = par_sep in refbody_parsed
     if is_multipar:
+        line_break = state.line_break
+        indent = state.indent
         new_refbody = ''
-        refbody_pars = refbody_parsed.split(state['par_sep'])
+        refbody_pars = refbody_parsed.split(par_sep)
         for par in refbody_pars:
-            for line in par.split(state['line_break']):
-                new_refbody += state['indent'] + line + state['line_break']
-            new_refbody = new_refbody.rstrip() + state['par_sep']
+            for line in par.split(line_break):
+                new_refbody += indent + line + line_break
+            new_refbody = new_refbody.rstrip() + par_sep
         refbody_parsed = new_refbody.rstrip()
-    footnote = {
-        'num': state['fn_counter'],
-        'body': refbody_parsed,
-        'is_multipar': is_multipar,
-    }
-    state['footnotes'].append(footnote)
-    state['fn_counter'] += 1
+        template = '[^%s]:\n%s'
+        if NOTABENOID_SPACES_WORKAROUND:
+            template = 'TODO: replace \'<-->\' with \'    \'\n' + template
+    else:
+        template = '[^%s]: %s'
+    state.footnotes.append(template % (num, refbody_parsed))
+    state.fn_counter += 1
     return res
 
 
 def maybe_formula(par):
     """ Returns a non-inline formula or empty string if it isn't detected. """
-    if par.lstrip().startswith(r'\[') and par.rstrip().endswith(r'\]'):
-        return '$$ ' + par.strip()[2:-2].strip() + ' $$'
+    m = FORMULA_RE.match(par)
+    if m:
+        return '$$ ' + m.group('formula').strip() + ' $$'
     else:
         return ''
 
@@ -393,22 +601,23 @@ def process_toplevel_p(p_elem, state):
     paragraph footnotes after it.
 
     """
-    is_question = 'id' in p_elem.attrib and p_elem.attrib['id'] == 'question'
-    is_attribute = 'id' in p_elem.attrib and p_elem.attrib['id'] == 'attribute'
-    res = ''
+    p_id = p_elem.get('id')
+    is_question = p_id == 'question'
+    is_attribute = p_id == 'attribute'
+    parts = []
     if is_question or is_attribute:
-        res += '> '
+        parts.append('> ')
     formula = maybe_formula(p_elem.text or '')
     if formula:
-        res += formula
+        parts.append(formula)
     else:
-        res += process_childs(p_elem, state)
+        parts.append(process_childs(p_elem, state))
     if is_question:
-        res += state['line_break'] + '>' + state['line_break']
+        parts.append(state.line_break + '>' + state.line_break)
     else:
-        res += state['par_sep']
-    res += pop_footnotes(state)
-    return res
+        parts.append(state.par_sep)
+    parts.append(pop_footnotes(state))
+    return ''.join(parts)
 
 
 def process_toplevel_blockquote(elem, state):
@@ -418,37 +627,30 @@ def process_toplevel_blockquote(elem, state):
 
     """
     # TODO: check for formula only for entire fragment
-    res = maybe_formula(elem.text or '')
-    res += process_childs(elem, state)
+    res = maybe_formula(elem.text or '') + process_childs(elem, state)
     res = prefix_each_line('> ', res.strip())
-
-    res += state['par_sep']
-    res += pop_footnotes(state)
-    return res
+    return res + state.par_sep + pop_footnotes(state)
 
 
 def process_toplevel_img(img, state):
     """ Process toplevel <img/> element (child of <article/>). """
-    url = full_url(img.get('src'), context_url=state['base_url'])
+    url = full_url(img.get('src'), context_url=state.base_url)
     img_file = url.rstrip('/').rsplit('/', 1)[1]
     img_name, img_ext = img_file.rsplit('.')
     img_file_ru = img_name + '_ru.' + img_ext
 
-    title_text = img.get('title').replace('"', '\\"')
-    if len(title_text) == 0:
-        res = '![](/uploads/%s/%s)' % \
-            (state['slug'], img_file_ru) + state['line_break']
-    else:
-        res = '![](/uploads/%s/%s "%s")' % \
-            (state['slug'], img_file_ru, title_text) + state['line_break']
-    res += '[labels]' + state['line_break']
-    res += 'TODO' + state['line_break']
-    res += '[/labels]' + state['line_break']
-    res += 'render: ![](%s)' % url + state['par_sep']
-    return res
+    img_src = '/uploads/%s/%s' % (state.slug, img_file_ru)
+    # The title may be absent or empty.
+    title_text = img.get('title')
+    if title_text:
+        img_src += ' "%s"' % title_text.replace('"', '\\"')
+    tmpl = '![]({img_src}){lb}[labels]{lb}TODO{lb}[/labels]{lb}' \
+        'render: ![]({url}){par_sep}'
+    return tmpl.format(img_src=img_src, url=url, lb=state.line_break,
+                       par_sep=state.par_sep)
 
 
-def process_img(img, state):
+def process_img(img, state, marks=DEFAULT_MARKS):
     """ Hack for correctly handle for images in multiparagraph
     footnotes.
 
@@ -456,38 +658,114 @@ def process_img(img, state):
     return process_toplevel_img(img, state)
 
 
+# Handlers for elements met by process_childs, each one is called as
+# handler(elem, state, marks) and returns markdown without the element tail.
+INLINE_HANDLERS = {
+    'p': process_inline_p,
+    'em': process_em,
+    'strong': process_strong,
+    'b': process_strong,
+    'a': process_a,
+    'span': process_span,
+    'sup': process_sup,
+    'sub': process_sub,
+    'br': process_br,
+    'img': process_img,
+}
+
+# Handlers for childs of <article/>, called as handler(elem, state).
+TOPLEVEL_HANDLERS = {
+    'p': process_toplevel_p,
+    'blockquote': process_toplevel_blockquote,
+    'img': process_toplevel_img,
+}
+
+
+def open_title_cache():
+    """ Open titles cache stored in TITLE_CACHE_FILE.
+
+    An empty cache that isn't saved is returned if the file cannot be opened.
+
+    """
+    try:
+        safe_makedirs(os.path.dirname(TITLE_CACHE_FILE))
+        return shelve.open(TITLE_CACHE_FILE)
+    except dbm.error as exc:
+        logging.warning('Cannot open titles cache "%s": %s',
+                        TITLE_CACHE_FILE, str(exc))
+        return contextlib.nullcontext({})
+
+
+def cached_title(cache, url, now):
+    """ Get a title from the titles cache or None if it's missing or stale.
+
+    Titles are stored with the time they were downloaded at.
+
+    """
+    entry = cache.get(url)
+    # Earlier versions stored bare titles.
+    if not isinstance(entry, tuple) or now - entry[1] > TITLE_CACHE_MAX_AGE:
+        return None
+    return entry[0]
+
+
+def get_titles(urls, default_res='TODO', refresh=False):
+    """ Get titles of referenced pages concurrently.
+
+    Only titles missing in the titles cache or stale ones are downloaded,
+    all ones are downloaded again when 'refresh' is true. Returns titles in
+    the same order as 'urls', 'default_res' for ones cannot be got.
+
+    """
+    refs_cnt = len(urls)
+    if refs_cnt == 0:
+        return []
+    # The cache is only accessed from this thread.
+    with open_title_cache() as cache:
+        now = time.time()
+        if refresh:
+            titles = [None] * refs_cnt
+        else:
+            titles = [cached_title(cache, url, now) for url in urls]
+        # Links to different parts of the same page share the title, so
+        # each page is downloaded once.
+        pages = {}
+        for num, (url, title) in enumerate(zip(urls, titles), 1):
+            if title is None:
+                pages.setdefault(get_page_url(url), []).append(num)
+        with ThreadPoolExecutor(max_workers=TITLE_WORKERS) as executor:
+            fetched = executor.map(
+                lambda nums: get_title(nums[0], urls[nums[0] - 1], refs_cnt,
+                                       None),
+                pages.values())
+            for nums, title in zip(pages.values(), fetched):
+                for num in nums:
+                    if title is None:
+                        titles[num - 1] = default_res
+                    else:
+                        titles[num - 1] = title
+                        cache[urls[num - 1]] = (title, now)
+    return titles
+
+
 def postprocess_references(state):
     """ Format and return preparsed references. """
-    res = ''
-    refs_cnt = len(state['references'])
-    for reference in state['references']:
-        if state['args']['no_link_title']:
-            title_text = 'TODO'
-        else:
-            title_text = get_title(reference, refs_cnt).replace('"', '\\"')
-        res += '[%s]: %s "%s"' % \
-            (reference['num'], reference['url'], title_text) + state['par_sep']
-    return res
+    parts = []
+    if state.args['no_link_title']:
+        titles = ['TODO'] * len(state.references)
+    else:
+        titles = get_titles(list(state.references),
+                            refresh=state.args['refresh_link_titles'])
+    for num, (url, title) in enumerate(zip(state.references, titles), 1):
+        title_text = title.replace('"', '\\"')
+        parts.append('[%s]: %s "%s"' % (num, url, title_text))
+        parts.append(state.par_sep)
+    return ''.join(parts)
 
 
 def new_parser(url, args):
     """ Return new (clean) parser state. """
-    state = {
-        'num': None,
-        'slug': None,
-        'base_url': url,
-        'ref_counter': 1,
-        'fn_counter': 1,
-        'par_sep': '\n\n',
-        'line_break': '\n',
-        'indent': ' ' * 4,
-        'footnotes': [],
-        'references': [],
-        'args': args,
-    }
-    if NOTABENOID_SPACES_WORKAROUND:
-        state['indent'] = '<-->'
-    return state
+    return ParserState(url, args)
 
 
 def process_article(url, html, args):
@@ -499,37 +777,38 @@ def process_article(url, html, args):
 
     """
     # The source HTML has no <meta charset="..."> tag. We should point the
-    # source HTML encoding to lxml. Let's add the tag manually: I see no other
-    # way to point the encoding. See also the get_page() comment.
-    html = re.sub(b'<head>', b'<head><meta charset="utf-8">', html, 1)
-
-    doc = lxml.html.document_fromstring(html)
-    article = doc.xpath('//body//article')[0]
+    # source HTML encoding to lxml, so pass it to the parser. See also the
+    # get_page() comment.
+    article = find_first(html, 'article', encoding='utf-8')
+    if article is None:
+        raise RuntimeError('No <article/> element in {}'.format(url))
+    # The tree is built up to the end of <article/>, including the navigation
+    # bar and the title before it.
+    doc = article.getroottree()
     article_html = inner_html(article)
 
     state = new_parser(url, args)
 
-    res = process_article_title(doc, state)
+    out = io.StringIO()
+    out.write(process_article_title(doc, state))
     childs_cnt = len(article)
     childs_processed = 0
-    func_dict = {
-        'p': process_toplevel_p,
-        'blockquote': process_toplevel_blockquote,
-        'img': process_toplevel_img,
-    }
+    write = out.write
+    get_handler = TOPLEVEL_HANDLERS.get
     for child in article:
         logging.info('Processed %d/%d top level elements',
                      childs_processed, childs_cnt)
-        if child.tag in func_dict.keys():
-            res += func_dict[child.tag](child, state)
+        handler = get_handler(child.tag)
+        if handler is not None:
+            write(handler(child, state))
         else:
             logging.warning('Unexpected toplevel element: ' + child.tag)
         childs_processed += 1
 
     logging.info('Postprocessing references...')
-    res += postprocess_references(state)
+    out.write(postprocess_references(state))
 
-    return article_html, res.strip(), state
+    return article_html, out.getvalue().strip(), state
 
 
 def usage(file=sys.stderr):
@@ -553,6 +832,11 @@ Available options are the following.\n\
 --no-link-title   Don\'t collect titles for linked pages. It speeds up the\n\
                   process a lot.\n\
 \n\
+--refresh-link-titles\n\
+                  Download all titles for linked pages again. Otherwise\n\
+                  titles collected during last 30 days are taken from\n\
+                  ~/.cache/what_if_parse/titles* files.\n\
+\n\
 --help | -h | -?  Display this cheatsheet.' % sys.argv[0], file=file)
 
 
@@ -567,6 +851,7 @@ def get_args():
         'native_newline': False,
         'verbose': False,
         'no_link_title': False,
+        'refresh_link_titles': False,
         'fetch_all_articles': False,
         'output_directory': '.',
         'timestamp_in_filename': True,
@@ -589,6 +874,8 @@ def get_args():
             args['native_newline'] = True
         elif a == '--no-link-title':
             args['no_link_title'] = True
+        elif a == '--refresh-link-titles':
+            args['refresh_link_titles'] = True
         elif a.isdigit() or a == 'all':
             if has_url:
                 logging.critical(
@@ -612,14 +899,20 @@ def get_args():
     return (url, args)
 
 
-def download_article(url):
+def download_article(url, download=None):
     """ Return string with HTML of requested article or exit with
     an error.
 
+    If 'download' future is passed, the page is taken from it instead of
+    getting it here.
+
     """
     logging.info('Download article from %s', url)
     try:
-        html = get_page(url, raise_non_text_html=True)
+        if download is None:
+            html = get_page(url, raise_non_text_html=True)
+        else:
+            html = download.result()
     except GetPageError as exc:
         logging.critical('==== Following error occured when getting page ====')
         logging.critical(str(exc))
@@ -646,12 +939,15 @@ def save_article(slug, args, a_html, a_md):
 
     # https://stackoverflow.com/a/23434608
     newline = None if args['native_newline'] else ''
+    # Write the trailing newline separately to don't copy whole article.
     with io.open(html_file, 'w', encoding='utf-8', newline=newline) as f:
         logging.info('Write article in html to file %s', html_file)
-        f.write(a_html + '\n')
+        f.write(a_html)
+        f.write('\n')
     with open(md_file, 'w', encoding='utf-8', newline=newline) as f:
         logging.info('Write article in markdown to file %s', md_file)
-        f.write(a_md + '\n')
+        f.write(a_md)
+        f.write('\n')
 
 
 def prettify_logging():
@@ -675,19 +971,48 @@ def main():
     prettify_logging()
     url, args = get_args()
     if args['fetch_all_articles']:
-        while True:
+        # Files of an article are written while the next one is processed.
+        # Numbers of all previous articles are known once the latest one is
+        # parsed, so some of them are downloaded ahead.
+        with ThreadPoolExecutor(max_workers=1) as saver, \
+                ThreadPoolExecutor(max_workers=ARTICLE_PREFETCH) as loader:
+            saving = None
+            downloads = collections.deque()
+            expected_num = None
             html = download_article(url)
-            a_html, a_md, state = process_article(url, html, args)
-            slug = state['slug']
-            num = state['num']
-            save_article(slug, args, a_html, a_md)
-            if num == 1:
-                break
-            url = 'https://what-if.xkcd.com/{num}/'.format(num=num-1)
+            while True:
+                a_html, a_md, state = process_article(url, html, args)
+                slug = state.slug
+                num = state.num
+                if num != expected_num:
+                    # Downloads ahead are useless when numbering differs
+                    # from the expected one, so continue from this article.
+                    if expected_num is not None:
+                        logging.warning('Article %s has number %d instead'
+                                        ' of %d', url, num, expected_num)
+                    for _, _, download in downloads:
+                        download.cancel()
+                    downloads.clear()
+                    prefetch_num = num - 1
+                while len(downloads) < ARTICLE_PREFETCH and prefetch_num > 0:
+                    prefetch_url = 'https://what-if.xkcd.com/{num}/'.format(
+                        num=prefetch_num)
+                    download = loader.submit(get_page, prefetch_url,
+                                             raise_non_text_html=True)
+                    downloads.append((prefetch_num, prefetch_url, download))
+                    prefetch_num -= 1
+                if saving is not None:
+                    saving.result()
+                saving = saver.submit(save_article, slug, args, a_html, a_md)
+                if not downloads:
+                    break
+                expected_num, url, download = downloads.popleft()
+                html = download_article(url, download)
+            saving.result()
     else:
         html = download_article(url)
         a_html, a_md, state = process_article(url, html, args)
-        slug = state['slug']
+        slug = state.slug
         save_article(slug, args, a_html, a_md)
 
 